@@ -1,7 +1,9 @@
 import datetime
+import functools
 import os.path
+import re
 import textwrap
-from collections import deque
+import threading
 from urllib.parse import urlparse
 
 import feedgen.ext.base
@@ -52,7 +54,7 @@ def render_node(id=None):
         id = request.view_args['id']
 
     if not hasattr(g, 'endpoint_info_stack'):
-        g.endpoint_info_stack = deque()
+        g.endpoint_info_stack = []
     try:
         endpoint_info = request.endpoint, request.view_args
     except RuntimeError:
@@ -67,15 +69,22 @@ def render_node(id=None):
             g.endpoint_info_stack.pop()
 
 
+# EndpointInfo is immutable, so we can reuse the common ones
+MAIN_ENDPOINT_INFO = EndpointInfo('main')
+FEED_ENDPOINT_INFO = EndpointInfo('feed')
+
+
 def get_real_endpoint(endpoint_info_stack=None):
     if endpoint_info_stack is None:
-        endpoint_info_stack = getattr(g, 'endpoint_info_stack', ())
+        endpoint_info_stack = getattr(g, 'endpoint_info_stack', None)
+    if not endpoint_info_stack:
+        return MAIN_ENDPOINT_INFO
     for endpoint, view_args in endpoint_info_stack:
         if endpoint == 'feed.tag_feed':
             return EndpointInfo('feed', tuple(sorted(view_args['tags'])))
         if endpoint == 'feed.feed':
-            return EndpointInfo('feed')
-    return EndpointInfo('main')
+            return FEED_ENDPOINT_INFO
+    return MAIN_ENDPOINT_INFO
 
 
 @main_bp.app_template_global()
@@ -89,17 +98,31 @@ def node_read_time(id=None):
 def url_for_node(id=None, **values):
     if id is None:
         id = request.view_args['id']
+    # usually there are no args, so there's nothing to merge
+    if not request.args:
+        return url_for('main.page', id=id, **values)
     kwargs = dict(request.args)
     kwargs.update(values)
     return url_for('main.page', id=id, **kwargs)
 
 
 def get_project_url():
-    return current_app.config.get('PROJECT_URL') or get_storage().get_project_url()
+    # called a few times per feed entry; it doesn't change during a request
+    if 'project_url' not in g:
+        g.project_url = (
+            current_app.config.get('PROJECT_URL') or get_storage().get_project_url()
+        )
+    return g.project_url
+
+
+def get_abs_url_prefix():
+    if 'abs_url_prefix' not in g:
+        g.abs_url_prefix = get_project_url().rstrip('/')
+    return g.abs_url_prefix
 
 
 def abs_page_url_for(id):
-    return get_project_url().rstrip('/') + url_for('main.page', id=id)
+    return get_abs_url_prefix() + url_for('main.page', id=id)
 
 
 @main_bp.route('/', defaults={'id': 'index'})
@@ -110,20 +133,43 @@ def page(id):
     # TODO: be more precise in what we're catching
     except FileNotFoundError:
         return abort(404)
-    # TODO: page should have a template attribute we're using
-    template = current_app.jinja_env.select_template(
-        [os.path.join('custom', id + '.html'), 'base.html']
-    )
+    template = select_page_template(id)
     now = datetime.datetime.now(datetime.timezone.utc)
     return render_template(template, page=page, now=now)
 
 
+def get_template_cache():
+    # get_template() probes the loader on every call, even if the template
+    # is already compiled; the cache is per app (and not an lru_cache keyed
+    # on the environment), so it doesn't keep other apps alive (e.g. in tests)
+    return current_app.extensions['template_cache']
+
+
+def select_page_template(id):
+    # TODO: page should have a template attribute we're using
+    # Jinja template names always use forward slashes
+    name = 'custom/' + id + '.html'
+    cache = get_template_cache()
+    if name not in cache:
+        try:
+            cache[name] = current_app.jinja_env.get_template(name)
+        except jinja2.TemplateNotFound:
+            # not cached, so custom templates added while serving get used
+            return current_app.jinja_env.get_template('base.html')
+    return cache[name]
+
+
+@main_bp.before_app_request
+def clear_template_cache():
+    # the cached templates would never get reloaded otherwise
+    if current_app.jinja_env.auto_reload:
+        get_template_cache().clear()
+
+
 @main_bp.route('/_file/<id>/<path:path>')
 def file(id, path):
-    return send_from_directory(
-        os.path.join(current_app.config['PROJECT_ROOT'], 'files'),
-        os.path.join(id, path),
-    )
+    # send_from_directory() does a safe join, so '/' is fine here
+    return send_from_directory(current_app.config['FILES_ROOT'], f'{id}/{path}')
 
 
 @main_bp.app_template_filter('humanize_apnumber')
@@ -141,7 +187,12 @@ main_bp.add_app_template_filter(yaml.safe_dump, 'to_yaml')
 
 @main_bp.app_template_filter('percent_encode')
 def percent_encode(s, encoding="ascii"):
-    return ''.join([f'%{b:0>2x}' for b in s.encode(encoding)])
+    # unlike urllib.parse.quote(), this encodes *all* the characters
+    # (e.g. to obfuscate email addresses); bytes.hex() does it in C
+    data = s.encode(encoding)
+    if not data:
+        return ''
+    return '%' + data.hex('%')
 
 
 # BEGIN feed blueprint
@@ -183,16 +234,17 @@ def make_feed(storage, id, tags=None):
 
     fg = feedgen.feed.FeedGenerator()
     # TODO: link to tag page once we have one
-    fg.id(abs_page_url_for(id))  # required
+    page_url = abs_page_url_for(id)
+    fg.id(page_url)  # required
 
-    feed_title = page.title
+    title_parts = [page.title]
     if id != 'index':
-        feed_title = index.title + ': ' + feed_title
-    if tags:
-        feed_title += f" {' '.join(f'#{t}' for t in tags)}"
-    fg.title(feed_title)  # required
+        title_parts[:0] = [index.title, ': ']
+    for tag in tags or ():
+        title_parts.append(f' #{tag}')
+    fg.title(''.join(title_parts))  # required
 
-    fg.link(href=abs_page_url_for(id), rel='alternate')
+    fg.link(href=page_url, rel='alternate')
     # TODO: link to tag page once we have one
     fg.link(href=abs_feed_url_for(id, tags), rel='self')
     # remove the default generator
@@ -207,27 +259,24 @@ def make_feed(storage, id, tags=None):
     # sort ascending, because feedgen reverses the entries
     children = list(storage.get_children(id, sort='published', tags=tags))
 
-    if not children:
-        feed_updated = '1970-01-01T00:00:00Z'
-    else:
-        feed_updated = max(
-            date
-            for child in children
-            for date in (
-                child.meta.get('updated', child.meta['published']),
-                child.meta['published'],
-            )
-        )
+    # only render the most recent entries, if asked to
+    max_entries_source = page if 'feed-max-entries' in page.meta else index
+    max_entries = max_entries_source.feed_max_entries
+    if max_entries is not None:
+        children = children[-max_entries:]
 
-    fg.updated(feed_updated)  # required
+    # computed in the entry loop, to avoid another pass over children
+    feed_updated = None
 
     for child in children:
         fe = fg.add_entry()
         fe.register_extension('atomxmlbase', AtomXMLBaseExt, atom=True, rss=False)
+        child_url = abs_page_url_for(child.id)
 
-        fe.id(abs_page_url_for(child.id))  # required
+        fe.id(child_url)  # required
         fe.title(child.title)  # required
-        fe.link(href=abs_page_url_for(child.id))
+        fe.link(href=child_url)
+        fe.atomxmlbase.base(child_url)
 
         if 'author' in child.meta:
             fe.author(
@@ -235,14 +284,25 @@ def make_feed(storage, id, tags=None):
                 email=child.meta['author'].get('email'),
             )
 
-        fe.updated(child.meta.get('updated', child.meta['published']))  # required
-        fe.published(child.meta['published'])
+        published = child.meta['published']
+        updated = child.meta.get('updated', published)
+        fe.updated(updated)  # required
+        fe.published(published)
+
+        if feed_updated is None:
+            feed_updated = max(updated, published)
+        else:
+            feed_updated = max(feed_updated, updated, published)
 
         if child.summary:
             fe.summary(child.summary)
 
         fe.content(content=render_node(child.id), type='html')
 
+    if feed_updated is None:
+        feed_updated = '1970-01-01T00:00:00Z'
+    fg.updated(feed_updated)  # required
+
     return fg
 
 
@@ -251,20 +311,55 @@ def abs_feed_url_for(id, tags=None):
         url = url_for('feed.feed', id=id)
     else:
         url = url_for('feed.tag_feed', id=id, tags=tags)
-    return get_project_url().rstrip('/') + url
+    return get_abs_url_prefix() + url
 
 
 class AtomXMLBaseExt(feedgen.ext.base.BaseEntryExtension):
+    """Set xml:base on an entry, with fe.atomxmlbase.base(url).
+
+    The URL is passed explicitly since we already have it,
+    instead of looking up the entry's alternate link in the tree.
+
+    """
+
+    def __init__(self):
+        self._base = None
+
+    def base(self, base=None):
+        if base is not None:
+            self._base = base
+        return self._base
+
     def extend_atom(self, entry):
-        entry.base = entry.find("./link[@rel='alternate']").attrib['href']
+        if self._base is not None:
+            entry.base = self._base
         return entry
 
 
 # BEGIN markdown
 
 
+URL_PATH_RE = re.compile(r'^[^?#]*')
+URL_SCHEME_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*(?=:)')
+
+
+def maybe_has_scheme(url, schemes):
+    """Cheap urlparse(url).scheme in schemes, to reject URLs early.
+
+    If the URL starts with a valid scheme, urlparse() finds the same one.
+    Otherwise, it may still strip whitespace and find one, so we say maybe.
+
+    """
+    match = URL_SCHEME_RE.match(url)
+    if not match:
+        return True
+    return match[0].lower() in schemes
+
+
 def build_page_url(url, text=None):
     """Markdown schema-less URL -> web app page URL."""
+    if not maybe_has_scheme(url, ('node',)):
+        return None
     url_parsed = urlparse(url)
     if url_parsed.scheme not in ('node', ''):
         return None
@@ -287,7 +382,8 @@ def build_page_url(url, text=None):
 
     new_url = url_for_node(id=id, **kwargs)
     if not path:
-        new_url = urlparse(new_url)._replace(path='').geturl()
+        # url_for() URLs are quoted, so the path ends at the first ? or #
+        new_url = URL_PATH_RE.sub('', new_url, count=1)
 
     if not text:
         text = id
@@ -300,6 +396,8 @@ def build_file_url(url, text=None):
 
     # TODO: maybe use file: instead?
 
+    if not maybe_has_scheme(url, ('attachment',)):
+        return None
     url_parsed = urlparse(url)
     if url_parsed.scheme != 'attachment':
         return None
@@ -321,6 +419,8 @@ def build_file_url(url, text=None):
 
 def build_external_url(url, text=None):
     """Mark HTTP(S) URLs as external."""
+    if not maybe_has_scheme(url, ('http', 'https')):
+        return None
     url_parsed = urlparse(url)
     if url_parsed.scheme not in ('http', 'https'):
         return None
@@ -344,15 +444,27 @@ def load_literalinclude(url):
     # TODO: check path doesn't go above <project_root>/files/<id>
     # TODO: this is cacheable, and should be done by storage
 
-    actual_path = os.path.join(current_app.config['PROJECT_ROOT'], 'files', id, path)
-    with open(actual_path) as f:
-        return list(f)
+    actual_path = os.path.join(current_app.config['FILES_ROOT'], id, path)
+    return read_lines(actual_path, os.stat(actual_path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=128)
+def read_lines(path, mtime):
+    # mtime is only here so changed files get read again
+    with open(path) as f:
+        return tuple(f)
+
+
+def get_snippet_template(snippet):
+    name = 'snippets/' + snippet + '.html'
+    cache = get_template_cache()
+    if name not in cache:
+        cache[name] = current_app.jinja_env.get_template(name)
+    return cache[name]
 
 
 def render_snippet(snippet, text, options):
-    template = current_app.jinja_env.get_template(
-        os.path.join('snippets', snippet + '.html')
-    )
+    template = get_snippet_template(snippet)
 
     page = get_storage().get_page(request.view_args['id'])
 
@@ -366,13 +478,22 @@ def render_snippet(snippet, text, options):
     )
 
 
-# For now, we're OK with a global, non-configurable markdown instance.
+# For now, we're OK with a global, non-configurable markdown instance
+# (one per thread, since we don't know if the Markdown object is thread-safe).
+
+_markdown_local = threading.local()
+
 
-markdown = make_markdown(
-    url_rewriters=[build_page_url, build_file_url, build_external_url],
-    load_literalinclude=load_literalinclude,
-    render_snippet=render_snippet,
-)
+def markdown(text):
+    try:
+        md = _markdown_local.markdown
+    except AttributeError:
+        md = _markdown_local.markdown = make_markdown(
+            url_rewriters=[build_page_url, build_file_url, build_external_url],
+            load_literalinclude=load_literalinclude,
+            render_snippet=render_snippet,
+        )
+    return md(text)
 
 
 # BEGIN app creation
@@ -393,8 +514,10 @@ class ListConverter(BaseConverter):
 
         if isinstance(values, str):
             return to_url(values)
+        if len(values) == 1:
+            return to_url(values[0])
 
-        return ','.join(to_url(value) for value in values)
+        return ','.join([to_url(value) for value in values])
 
 
 def create_app(
@@ -402,6 +525,7 @@ def create_app(
     *,
     project_url=None,
     node_cache_decorator=None,
+    jinja_cache_path=None,
 ):
     app = Flask(
         __name__,
@@ -411,12 +535,20 @@ def create_app(
     )
 
     app.config['PROJECT_ROOT'] = project_root
+    app.config['FILES_ROOT'] = os.path.join(project_root, 'files')
     if project_url:
         app.config['PROJECT_URL'] = project_url
 
     app.jinja_env.undefined = jinja2.StrictUndefined
+    if jinja_cache_path:
+        # the cache checks the template source, so it is safe to share
+        os.makedirs(jinja_cache_path, exist_ok=True)
+        app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(
+            jinja_cache_path, '%s.cache'
+        )
     app.jinja_env.filters['dedent'] = textwrap.dedent
     app.url_map.converters['list'] = ListConverter
+    app.extensions['template_cache'] = {}
 
     app.register_blueprint(main_bp)
     app.register_blueprint(feed_bp, url_prefix='/_feed')
@@ -1,13 +1,12 @@
 import functools
+import hashlib
 import os.path
-import pathlib
-import warnings
+import re
 from dataclasses import dataclass
 from typing import NamedTuple
 
-import bs4
+import lxml.html
 import markupsafe
-import readtime
 from werkzeug.exceptions import NotFound
 
 import gen
@@ -17,9 +16,8 @@ from .checks import RenderingChecker
 from .storage import Storage
 
 
-warnings.filterwarnings(
-    'ignore', message='No parser was explicitly specified', module='gen.caching'
-)
+# see NodeState.match_url()
+PAGE_PATH_RE = re.compile(r'/([^/%?#]+)')
 
 
 @dataclass
@@ -42,6 +40,8 @@ class NodeState:
     checker: MetaChecker = None
     link_checker: LinkChecker = None
     dependency_tracker: 'DependecyTracker' = None
+    _url_adapter: 'werkzeug.routing.MapAdapter' = None  # noqa
+    _client: 'flask.testing.FlaskClient' = None  # noqa
 
     def render_node(self, id, real_endpoint, **values):
         # This is here because we need a method to cache.
@@ -54,6 +54,9 @@ class NodeState:
 
     def node_read_time(self, id):
         # This is here because we need a method to cache.
+        # readtime is slow to import (it pulls in pyquery, markdown2 etc.),
+        # and not all pages need it.
+        import readtime
 
         html = self.render_node(id, EndpointInfo())
 
@@ -66,9 +69,11 @@ class NodeState:
 
         return readtime.of_html(html)
 
-    def get_soup(self, id, real_endpoint):
+    def get_tree(self, id, real_endpoint):
         # This is here because we need a method to cache.
-        return bs4.BeautifulSoup(self.render_page(id, real_endpoint))
+        # The checkers only need elements and attributes, so we use lxml
+        # directly; it's a lot faster than building a BeautifulSoup tree.
+        return lxml.html.document_fromstring(self.render_page(id, real_endpoint))
 
     def _node_context(self, id, values=None):
         url = self.url_for_node(id, **(values or {}))
@@ -76,10 +81,12 @@ class NodeState:
 
     def render_page(self, id, real_endpoint):
         # real_endpoint is set for cache invalidation.
-        with self._app.test_client() as client:
-            rv = client.get(self.url_for_node(id))
-            assert rv.status_code == 200, rv.status
-            return rv.get_data(as_text=True)
+        # no need for a new client for each page (or for preserving contexts)
+        if self._client is None:
+            self._client = self._app.test_client()
+        rv = self._client.get(self.url_for_node(id))
+        assert rv.status_code == 200, rv.status
+        return rv.get_data(as_text=True)
 
     def url_for_node(self, id, **values):
         from .app import url_for_node
@@ -87,13 +94,26 @@ class NodeState:
         with self._app.test_request_context():
             return url_for_node(id, **values)
 
-    def match_url(self, *args, **kwargs):
-        ctx = self._app.test_request_context()
+    def match_url(self, url):
+        # most internal links are to pages; other routes have more segments,
+        # so we can skip creating a request context just to match those
+        # (no % or ?, to stay out of the way of werkzeug decoding/parsing)
+        if match := PAGE_PATH_RE.fullmatch(url):
+            return 'main.page', {'id': match[1]}
+
         try:
-            return ctx.url_adapter.match(*args, **kwargs)
+            return self._get_url_adapter().match(url)
         except NotFound:
             return None
 
+    def _get_url_adapter(self):
+        # Creating a request context just to get a bound URL map is expensive.
+        # Created on first use, since the app config (e.g. SERVER_NAME)
+        # may still change after the app is created; after that, it doesn't.
+        if self._url_adapter is None:
+            self._url_adapter = self._app.test_request_context().url_adapter
+        return self._url_adapter
+
 
 """
 def cache_node_methods(self, cache_decorator):
@@ -121,11 +141,19 @@ def init_node_state(app, node_cache_decorator=None):
         state.render_node = node_cache_decorator(state.render_node)
         state.node_read_time = node_cache_decorator(state.node_read_time)
         # node_cache_decorator doesn't work, because pickle fails;
-        # lru_cache saves less than .1s ...
-        # state.get_soup = functools.lru_cache(state.get_soup)
+        # still, the checkers for a page can share one render + parse
+        # (MetaChecker checks one page at a time, so a small cache is enough)
+        state.get_tree = functools.lru_cache(maxsize=32)(state.get_tree)
+        # these need a new request context for every call, and only depend
+        # on the URL map and config, which don't change once we render stuff
+        state.url_for_node = functools.lru_cache(maxsize=4096)(state.url_for_node)
+        state.match_url = functools.lru_cache(maxsize=4096)(state.match_url)
 
     state.link_checker = link_checker = LinkChecker(state)
     if node_cache_decorator:
+        link_checker.get_fragments_and_urls = node_cache_decorator(
+            link_checker.get_fragments_and_urls
+        )
         link_checker.get_fragments = node_cache_decorator(link_checker.get_fragments)
         link_checker.get_internal_links = node_cache_decorator(
             link_checker.get_internal_links
@@ -184,16 +212,34 @@ class DependecyTracker:
 
 
 def intercept(fn, on_called=None, on_return=None):
-    @functools.wraps(fn)
-    def wrapper(*args, **kwargs):
-        if on_called:
+    # storage.get_page() is called a lot, so we pick the wrapper once,
+    # instead of checking which callbacks we have on every call
+
+    if on_called and on_return:
+
+        def wrapper(*args, **kwargs):
+            on_called(fn, *args, **kwargs)
+            rv = fn(*args, **kwargs)
+            on_return(fn, rv)
+            return rv
+
+    elif on_called:
+
+        def wrapper(*args, **kwargs):
             on_called(fn, *args, **kwargs)
-        rv = fn(*args, **kwargs)
-        if on_return:
+            return fn(*args, **kwargs)
+
+    elif on_return:
+
+        def wrapper(*args, **kwargs):
+            rv = fn(*args, **kwargs)
             on_return(fn, rv)
-        return rv
+            return rv
+
+    else:
+        return fn
 
-    return wrapper
+    return functools.wraps(fn)(wrapper)
 
 
 def intercept_node(fn, target):
@@ -205,15 +251,21 @@ class EndpointInfo(NamedTuple):
     tags: tuple = ()
 
 
+_MISS = object()
+
+
 def make_node_cache_decorator(cache: 'diskcache.Cache', log):  # noqa
     def node_cache_decorator(fn):
-        @functools.lru_cache
+        name = f'{fn.__module__}.{fn.__qualname__}'
+
+        # unbounded, since a miss here is a trip to the disk cache
+        @functools.lru_cache(maxsize=None)
         @functools.wraps(fn)
         def wrapper(id, *args):
-            key = (f'{fn.__module__}.{fn.__qualname__}', id) + args
+            key = (name, id) + args
 
-            rv = cache.get(key)
-            if rv is not None:
+            rv = cache.get(key, _MISS)
+            if rv is not _MISS:
                 log('hit ', *key)
                 return rv
 
@@ -233,35 +285,52 @@ def invalidate_cache(project, storage, cache):
 
     old_mtimes = cache.get('mtimes', {})
     new_mtimes = {}
+    old_hashes = cache.get('hashes', {})
+    new_hashes = {}
 
-    def check_mtime(key, path, glob):
+    def check_mtime(key, mtimes):
         old_mtime = old_mtimes.get(key, 0)
-        new_mtime = old_mtime
-        for path in pathlib.Path(path).glob(glob):  # noqa
-            new_mtime = max(new_mtime, path.stat().st_mtime)
+        new_mtime = max(mtimes, default=old_mtime)
         if new_mtime > old_mtime:
             new_mtimes[key] = new_mtime
 
-    check_mtime('dir:gen', gen.__path__[0], '**/*.py')
-    check_mtime('dir:templates', os.path.join(project, 'templates'), '**/*')
+    check_mtime('dir:gen', iter_mtimes(gen.__path__[0], '.py'))
+    check_mtime('dir:templates', iter_mtimes(os.path.join(project, 'templates')))
 
+    unchanged = set()
     for id, path in storage.get_page_paths():
-        check_mtime(f'node:{id}', content_root, path)
+        key = f'node:{id}'
+        path = os.path.join(content_root, path)
+        check_mtime(key, [os.stat(path).st_mtime])
+        if key not in new_mtimes:
+            continue
+        # git checkouts (and touch) change the mtime without changing the content
+        new_hashes[key] = hash_file(path)
+        if new_hashes[key] == old_hashes.get(key):
+            unchanged.add(key)
 
     to_evict = set()
 
-    if new_mtimes:
+    if not new_mtimes:
+        return set()
+
+    # one transaction for all the evictions, instead of one per evict()
+    with cache.transact(retry=True):
         if any(key.startswith('dir:') for key in new_mtimes):
             cache.clear(retry=True)
         else:
             dependents = invert_dependencies(cache.get('dependencies', {}))
 
-            for key in new_mtimes:
-                assert key.startswith('node:'), key
+            # transitively, since a cached node render may be part of
+            # another node's render, without the node being read again
+            ids = [key.partition(':')[2] for key in new_mtimes.keys() - unchanged]
+            while ids:
+                id = ids.pop()
+                key = f'node:{id}'
+                if key in to_evict:
+                    continue
                 to_evict.add(key)
-                to_evict.update(
-                    f'node:{d}' for d in dependents.get(key.partition(':')[2], ())
-                )
+                ids.extend(dependents.get(id, ()))
 
             for key in to_evict:
                 cache.evict(key, retry=False)
@@ -271,9 +340,37 @@ def invalidate_cache(project, storage, cache):
 
         cache.set('mtimes', mtimes)
 
+        hashes = old_hashes.copy()
+        hashes.update(new_hashes)
+        cache.set('hashes', hashes)
+
     return {key.partition(':')[2] for key in to_evict}
 
 
+def iter_mtimes(root, suffix=''):
+    """Yield the mtimes of everything under root whose name ends with suffix.
+
+    Like Path(root).glob(f'**/*{suffix}'), but without creating Path objects
+    (and, like it, without following symlinks to directories).
+
+    """
+    try:
+        entries = os.scandir(root)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with entries:
+        for entry in entries:
+            if entry.name.endswith(suffix):
+                yield entry.stat().st_mtime
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_mtimes(entry.path, suffix)
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).digest()
+
+
 def invert_dependencies(dependencies):
     rv = {}
     for key, values in dependencies.items():
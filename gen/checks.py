@@ -2,6 +2,11 @@ from dataclasses import dataclass
 from typing import NamedTuple
 from urllib.parse import urlparse
 
+from lxml import etree
+
+
+NON_HTTP_URL_PREFIXES = ('mailto:', 'tel:', 'javascript:', 'data:')
+
 
 class InternalLink(NamedTuple):
     endpoint: str
@@ -38,41 +43,57 @@ class MetaChecker:
 class LinkChecker:
     state: 'gen.cache.NodeState'  # noqa
 
-    def get_fragments(self, id, endpoint):
-        soup = self.state.get_soup(id, endpoint)
-        rv = set()
-
-        for element in soup.select('[id], a[name]'):
-            if 'id' in element.attrs:
-                rv.add(element['id'])
-            if element.name == 'a' and 'name' in element.attrs:
-                rv.add(element['name'])
+    def get_fragments_and_urls(self, id, endpoint):
+        # get_fragments() and get_internal_links() need the same tree,
+        # so we walk it only once; the URLs are in document order
+        tree = self.state.get_tree(id, endpoint)
+        fragments = set()
+        urls = {}
+
+        # tag=etree.Element skips comments and processing instructions
+        for element in tree.iter(etree.Element):
+            attrs = element.attrib
+            if 'id' in attrs:
+                fragments.add(attrs['id'])
+            if element.tag == 'a':
+                if 'name' in attrs:
+                    fragments.add(attrs['name'])
+                if 'href' in attrs:
+                    urls[attrs['href']] = None
+            elif element.tag == 'img':
+                if 'src' in attrs:
+                    urls[attrs['src']] = None
+
+        return fragments, list(urls)
 
-        return rv
+    def get_fragments(self, id, endpoint):
+        fragments, _ = self.get_fragments_and_urls(id, endpoint)
+        return fragments
 
     def get_internal_links(self, id, endpoint):
-        soup = self.state.get_soup(id, endpoint)
+        _, urls = self.get_fragments_and_urls(id, endpoint)
         rv = {}
+        # only needed for fragment-only URLs, and the same for all of them
+        page_path = None
 
-        for element in soup.select('a[href], img[src]'):
-            if element.name == 'a':
-                url = element['href']
-            elif element.name == 'img':
-                url = element['src']
-            else:
-                assert False, f"unexpected element: {element!r}"  # noqa
-
-            if url in rv:
+        for url in urls:
+            # common non-HTTP URLs; not worth parsing just to skip them
+            if url.startswith(NON_HTTP_URL_PREFIXES):
                 continue
 
             url_parsed = urlparse(url)
             if url_parsed.scheme not in ('http', 'https', ''):
                 continue
 
-            if not url_parsed.hostname and not url_parsed.path:
-                url_parsed = url_parsed._replace(
-                    path=urlparse(self.state.url_for_node(id)).path
-                )
+            # the URL map only matches paths, so absolute URLs never match;
+            # skip them before building anything for match_url()
+            if url_parsed.netloc:
+                continue
+
+            if not url_parsed.path:
+                if page_path is None:
+                    page_path = urlparse(self.state.url_for_node(id)).path
+                url_parsed = url_parsed._replace(path=page_path)
 
             match = self.state.match_url(url_parsed._replace(fragment='').geturl())
             if not match:
@@ -84,15 +105,13 @@ class LinkChecker:
 
     def check(self, id, endpoint):
         internal_links = self.get_internal_links(id, endpoint)
-        urls = []
+        urls = {}
 
         for url, link in internal_links.items():
             error = None
             target_id = link.args['id']
 
-            try:
-                self.state.storage.get_page(target_id)
-            except FileNotFoundError:
+            if not self.state.storage.page_exists(target_id):
                 error = "node not found"
 
             # freezing checks if the URL actually exists,
@@ -112,16 +131,22 @@ class LinkChecker:
                         error = "feed URL should not have fragment"
 
             if error:
-                urls.append({url: error})
+                urls[url] = error
 
         return {'internal-links': urls} if urls else {}
 
 
+# div.error
+ERROR_XPATH = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' error ')]"
+)
+
+
 @dataclass
 class RenderingChecker:
     state: 'gen.cache.NodeState'  # noqa
 
     def check(self, id, endpoint):
-        soup = self.state.get_soup(id, endpoint)
-        errors = [element.text for element in soup.select('div.error')]
+        tree = self.state.get_tree(id, endpoint)
+        errors = [element.text_content() for element in ERROR_XPATH(tree)]
         return {'markdown': errors} if errors else {}
@@ -32,13 +32,24 @@ def cli(ctx, project):
 @click.option('-h', '--host', default='localhost', help="The interface to bind to.")
 @click.option('-p', '--port', default=8080, type=int, help="The port to bind to.")
 @click.option('--open/--no-open', help="Open a browser.")
+@click.option(
+    '--cache/--no-cache',
+    'cache_option',
+    help="Cache compiled templates in the project directory.",
+)
 @click.pass_obj
-def serve(project, host, port, open):
+def serve(project, host, port, open, cache_option):
     from .app import create_app
 
     # TODO: threads, reload, debug
     url = f"http://{host}:{port}"
-    app = create_app(project, project_url=url)
+    app = create_app(
+        project,
+        project_url=url,
+        jinja_cache_path=(
+            os.path.join(project, '.gen/cache/jinja') if cache_option else None
+        ),
+    )
     open_fn = webbrowser.open if open else lambda url: None
     timer = threading.Timer(0.5, open_fn, (url,))
     try:
@@ -129,16 +140,14 @@ def freeze(ctx, project, outdir, force, deploy, cache_option, verbose):
         node_cache_decorator = functools.lru_cache
 
     from .app import create_app, get_project_url
-    from jinja2 import FileSystemBytecodeCache
 
-    app = create_app(project, node_cache_decorator=node_cache_decorator)
-
-    if cache_option:
-        jinja_cache_path = os.path.join(project, '.gen/cache/jinja')
-        os.makedirs(jinja_cache_path, exist_ok=True)
-        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
-            jinja_cache_path, '%s.cache'
-        )
+    app = create_app(
+        project,
+        node_cache_decorator=node_cache_decorator,
+        jinja_cache_path=(
+            os.path.join(project, '.gen/cache/jinja') if cache_option else None
+        ),
+    )
 
     app.config['GEN_FREEZING'] = True
 
@@ -158,37 +167,48 @@ def freeze(ctx, project, outdir, force, deploy, cache_option, verbose):
 
     freezer = make_freezer(app)
 
-    rv = freezer.freeze_yield()
-    if not verbose:
-        progressbar = click.progressbar(
-            rv,
-            item_show_func=lambda p: p.url if p else 'Done!',
-            show_pos=True,
-        )
-    else:
-        progressbar = contextlib.nullcontext(rv)
-    with progressbar as pages:
-        for page in pages:
-            log('done', page.path)
-
+    # commit the node cache writes made while rendering in one transaction,
+    # instead of one commit per write (reads are memoized in-process already);
+    # it holds the cache write lock, so it ends before the checks and deploy
     if cache_option:
-        # TODO: this logic should be handled by the cache invalidator
-        dependencies = cache.get('dependencies', {})
-        for id in evicted_nodes:
-            dependencies.pop(id, None)
-        new_dependencies = app.extensions['state'].dependency_tracker.dependencies
-        for key, value in new_dependencies.items():
-            # we only update dependencies for evicted nodes
-            # (nodes that were not evicted are not re-rendered,
-            # so dependencies will be wrong for them)
-            dependencies.setdefault(key, value)
-        cache.set('dependencies', dependencies)
+        transaction = cache.transact(retry=True)
+    else:
+        transaction = contextlib.nullcontext()
+
+    with transaction:
+        rv = freezer.freeze_yield()
+        if not verbose:
+            progressbar = click.progressbar(
+                rv,
+                item_show_func=lambda p: p.url if p else 'Done!',
+                show_pos=True,
+            )
+        else:
+            progressbar = contextlib.nullcontext(rv)
+        with progressbar as pages:
+            for page in pages:
+                log('done', page.path)
+
+        if cache_option:
+            # TODO: this logic should be handled by the cache invalidator
+            dependencies = cache.get('dependencies', {})
+            for id in evicted_nodes:
+                dependencies.pop(id, None)
+            new_dependencies = app.extensions['state'].dependency_tracker.dependencies
+            for key, value in new_dependencies.items():
+                # we only update dependencies for evicted nodes
+                # (nodes that were not evicted are not re-rendered,
+                # so dependencies will be wrong for them)
+                dependencies.setdefault(key, value)
+            cache.set('dependencies', dependencies)
 
     # TODO: maybe FREEZER_IGNORE_404_NOT_FOUND, so we don't fail fast for broken links
     # (and get a full error report later)
 
     if errors := dict(app.extensions['state'].checker.check_all()):
-        errors_str = yaml.safe_dump(errors)
+        # libyaml, if available; can be a lot of output for a very broken site
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        errors_str = yaml.dump(errors, Dumper=dumper)
         raise click.ClickException(f"Some checks failed:\n\n{errors_str}\n")
 
     # TODO: these should be per-freezer (it's only suitable for github pages)
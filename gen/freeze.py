@@ -1,3 +1,4 @@
+import functools
 import ntpath
 
 import flask_frozen
@@ -36,32 +37,36 @@ def make_freezer(app):
     # note that with log_url_for=True, we may actually generate a hidden
     # node if it's referred to from a template; maybe we should fix that
 
+    # all the generators go through the same pages, get them only once
+    @functools.lru_cache(maxsize=1)
+    def get_pages():
+        return get_storage().get_pages(discoverable=None)
+
     @freezer.register_generator
     def page():
-        for id in get_storage().get_page_ids(discoverable=None):
-            yield 'main.page', {'id': id}
+        for page in get_pages():
+            yield 'main.page', {'id': page.id}
 
     @freezer.register_generator
     def feed():
-        for page in get_storage().get_pages(discoverable=None):
+        for page in get_pages():
             if page.has_feed:
                 yield 'feed.feed', {'id': page.id}
 
     @freezer.register_generator
     def file():
         # only yield linked files
-        for id in get_storage().get_page_ids(discoverable=None):
-            for link in (
-                get_state().link_checker.get_internal_links(id, EndpointInfo()).values()
-            ):
+        link_checker = get_state().link_checker
+        for page in get_pages():
+            links = link_checker.get_internal_links(page.id, EndpointInfo())
+            for link in links.values():
                 if link.endpoint == 'main.file':
                     yield 'main.file', link.args
 
     @freezer.register_generator
     def tag_feed():
-        for id in get_storage().get_page_ids(discoverable=None):
-            page = get_storage().get_page(id)
+        for page in get_pages():
             for tags in page.tag_feeds:
-                yield 'feed.tag_feed', {'id': id, 'tags': tags}
+                yield 'feed.tag_feed', {'id': page.id, 'tags': tags}
 
     return freezer
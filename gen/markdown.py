@@ -1,4 +1,6 @@
 import re
+import shlex
+import subprocess
 from functools import lru_cache
 
 import mistune.directives
@@ -7,7 +9,8 @@ from mistune import escape_html
 from mistune import escape_url
 from mistune.directives import Directive
 from pygments import highlight
-from pygments.formatters import get_formatter_by_name
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import find_lexer_class_by_name
 from pygments.lexers import get_lexer_by_name
 from pygments.lexers import guess_lexer
 from pygments.lexers import guess_lexer_for_filename
@@ -24,20 +27,39 @@ def do_highlight(code, lang, options=None):
 def _do_highlight(code, lang, **options):
     # This is an optimization for interactive use (`gen serve`),
     # so a transient in-memory cache is fine.
-    try:
-        lexer = get_lexer_by_name(lang, **options)
-    except ValueError:
+    lexer_cls = find_lexer_class(lang)
+    if lexer_cls:
+        lexer = lexer_cls(**options)
+    else:
         try:
             lexer = guess_lexer(code, **options)
         except ValueError:
             lexer = get_lexer_by_name('text', **options)
-    formatter = get_formatter_by_name('html', **options)
+    formatter = get_html_formatter(**options)
     return highlight(code, lexer, formatter), lexer.name
 
 
-def parselinenos(spec: str, total: int) -> list:
-    """parselinenos('2,4-6,8-', 9) -> [1, 3, 4, 5, 7, 8]"""
-    # from sphinx.util
+@lru_cache(maxsize=None)
+def find_lexer_class(lang):
+    # Unknown names are slow to look up (Pygments scans the plugin
+    # entry points every time), so we cache misses too.
+    try:
+        return find_lexer_class_by_name(lang)
+    except ClassNotFound:
+        return None
+
+
+@lru_cache
+def get_html_formatter(**options):
+    # Creating a formatter builds the style tables; formatting doesn't
+    # change the formatter, so it's fine to reuse it.
+    return HtmlFormatter(**options)
+
+
+@lru_cache(maxsize=1024)
+def parselinenos(spec: str, total: int) -> tuple:
+    """parselinenos('2,4-6,8-', 9) -> (1, 3, 4, 5, 7, 8)"""
+    # from sphinx.util (returns a tuple, since it's cached)
     items = list()
     parts = spec.split(',')
     for part in parts:
@@ -58,7 +80,7 @@ def parselinenos(spec: str, total: int) -> list:
         except Exception as exc:
             raise ValueError('invalid line number spec: %r' % spec) from exc
 
-    return items
+    return tuple(items)
 
 
 def parse_block_code_options(info: str) -> dict:
@@ -130,8 +152,10 @@ def to_pygments_options(options, line_count):
 def render_highlighed_code(code, options):
     options = dict(options)
     lang = options.pop('language')
+    # the line count is only needed for open ranges in emphasize-lines
+    line_count = len(code.splitlines()) if 'emphasize-lines' in options else 0
     pygments_options = {'wrapcode': True}
-    pygments_options.update(to_pygments_options(options, len(code.splitlines())))
+    pygments_options.update(to_pygments_options(options, line_count))
 
     # To generate a unique (and stable-ish) id to use as lineanchors,
     # we need to know how many code blocks with the same filename
@@ -141,28 +165,37 @@ def render_highlighed_code(code, options):
 
     html, data_lang = do_highlight(code, lang, pygments_options)
 
-    linenos_pre_index = html.index('<pre>')
-    try:
-        code_pre_index = html.index('<pre>', linenos_pre_index + 1)  # noqa
-    except ValueError:
-        code_pre_index, linenos_pre_index = linenos_pre_index, None  # noqa
+    # All the changes are to the wrapper tags before the code,
+    # so we make them on that (short) prefix only, and then
+    # copy the (possibly long) highlighted code just once.
 
-    # wrapcode doesn't work for the linenos, so we add it by hand
-    if linenos_pre_index:
-        html = html.replace('<pre>', '<pre class="code"><code>', 1)
-        html = html.replace('</pre>', '</code></pre>', 1)
+    # with linenos, the first <pre> is the line numbers, and the second the code
+    code_pre_index = html.index('<pre>')
+    linenos_pre_index = None
+    next_pre_index = html.find('<pre>', code_pre_index + 1)
+    if next_pre_index != -1:
+        linenos_pre_index, code_pre_index = code_pre_index, next_pre_index
 
-    html = html.replace(
-        '<pre>', '<pre class="code" data-lang="' + escape_html(data_lang) + '">', 1
-    )
+    head = html[:code_pre_index]
 
     # add .code-container to the outermost element
     # pygments >= 2.12 required
-    html = html.replace(
-        '<div class="highlight">', '<div class="highlight code-container">'
+    head = head.replace(
+        '<div class="highlight">', '<div class="highlight code-container">', 1
     )
 
-    return html
+    # wrapcode doesn't work for the linenos, so we add it by hand
+    if linenos_pre_index is not None:
+        head = head.replace('<pre>', '<pre class="code"><code>', 1)
+        head = head.replace('</pre>', '</code></pre>', 1)
+
+    return (
+        head
+        + '<pre class="code" data-lang="'
+        + escape_html(data_lang)
+        + '">'
+        + html[code_pre_index + len('<pre>') :]
+    )
 
 
 def render_plain_code(code):
@@ -226,7 +259,9 @@ class MyRenderer(mistune.HTMLRenderer):
 
 
 def record_toc_heading(text, level, state):
-    existing_tids = set(t[0] for t in state['toc_headings'])
+    # the ids in state['toc_headings'], kept up to date here,
+    # so we don't build a new set for every heading
+    existing_tids = state.setdefault('toc_tids', set())
     slug = slugify(text)
 
     tid = slug
@@ -235,21 +270,20 @@ def record_toc_heading(text, level, state):
         tid = slug + '-' + str(counter)
         counter += 1
 
+    existing_tids.add(tid)
     state['toc_headings'].append((tid, text, level))
     return {'type': 'theading', 'text': text, 'params': (level, tid)}
 
 
 def render_html_theading(text, level, tid):
-    level = level + 1
-    tag = 'h' + str(level)
+    tag = f'h{level + 1}'
 
     headerlink = (
-        '<span class="headerlink">&nbsp;<a href="#'
-        + escape_url(tid)
-        + '" title="permalink">#</a></span>'
+        '<span class="headerlink">&nbsp;'
+        f'<a href="#{escape_url(tid)}" title="permalink">#</a></span>'
     )
 
-    return '<' + tag + ' id="' + tid + '">' + text + headerlink + '</' + tag + '>\n'
+    return f'<{tag} id="{tid}">{text}{headerlink}</{tag}>\n'
 
 
 def plugin_toc_fix(md):
@@ -259,15 +293,14 @@ def plugin_toc_fix(md):
 
 
 def render_html_footnote_item(text, key, index):
-    i = str(index)
-    back = ' <a href="#fnref-' + i + '" class="footnote"><sup>[return]</sup></a>'
+    back = f' <a href="#fnref-{index}" class="footnote"><sup>[return]</sup></a>'
 
     text = text.rstrip()
     if text.endswith('</p>'):
-        text = text[:-4] + back + '</p>'
+        text = f'{text[:-4]}{back}</p>'
     else:
         text = text + back
-    return '<li id="fn-' + i + '">' + text + '</li>\n'
+    return f'<li id="fn-{index}">{text}</li>\n'
 
 
 def plugin_footnotes_fix(md):
@@ -275,6 +308,9 @@ def plugin_footnotes_fix(md):
         md.renderer.register('footnote_item', render_html_footnote_item)
 
 
+INDENT_RE = re.compile(r'\s*')
+
+
 class LiteralInclude(Directive):
     def __init__(self, load_lines):
         self.load_lines = load_lines
@@ -315,7 +351,7 @@ class LiteralInclude(Directive):
                 # this messes with line numbers, a fix for that requires
                 # https://github.com/pygments/pygments/issues/2322
                 if ellipsis_option and prev_i is not None and i != prev_i + 1:
-                    indent = re.match(r'^\s*', line).group(0)
+                    indent = INDENT_RE.match(line).group(0)
                     lines.append(f'{indent}{ellipsis_option}\n')
 
                 lines.append(line)
@@ -397,8 +433,6 @@ class Subprocess(Directive):
         if p.returncode == 0:
             return {'type': 'block_html', 'raw': p.stdout}
         else:
-            import shlex
-
             message = (
                 f'<code>{escape(shlex.join(self.args))}</code> exited'
                 f' with status <code>{p.returncode}</code>\n'
@@ -417,8 +451,6 @@ class Subprocess(Directive):
 
 @lru_cache
 def subprocess_run(args, input):
-    import subprocess
-
     return subprocess.run(args, input=input, capture_output=True, text=True)
 
 
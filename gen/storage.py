@@ -2,12 +2,17 @@
 Data model stuff.
 
 """
+import operator
 import os.path
 from dataclasses import dataclass
 from functools import cached_property
+from functools import lru_cache
 
 import yaml
 
+# libyaml is a lot faster, if available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 @dataclass
 class Storage:
@@ -17,12 +22,12 @@ class Storage:
 
     def get_page_paths(self):
         for entry in os.scandir(self.path):
-            if not entry.is_file():
+            # check the name first, it's cheaper than is_file()
+            if not entry.name.endswith('.md') or entry.name == '.md':
                 continue
-            name, ext = os.path.splitext(entry.name)
-            if ext != '.md':
+            if not entry.is_file():
                 continue
-            yield name, entry.name
+            yield entry.name[:-3], entry.name
 
     def get_all_page_ids(self):
         for name, _ in self.get_page_paths():
@@ -38,30 +43,34 @@ class Storage:
         sort='id',
         reverse=False,
     ):
+        if sort == 'id' or invert:
+            key = operator.attrgetter('id')
+        else:
+            if sort not in ('published',):
+                raise ValueError(f"unknown sort: {sort!r}")
+            key = lambda p: p.meta[sort]  # noqa
+
         filters = []
         if hidden is not None:
-            filters.append(lambda p: p.hidden is bool(hidden))
+            hidden = bool(hidden)
+            filters.append(lambda p: p.hidden is hidden)
         if discoverable is not None:
-            filters.append(lambda p: p.discoverable is bool(discoverable))
+            discoverable = bool(discoverable)
+            filters.append(lambda p: p.discoverable is discoverable)
         if tags is not None:
             filters.append(lambda p: any(tag in p.tags for tag in tags))
         if sort != 'id':
             filters.append(lambda p: sort in p.meta)
 
-        keep = lambda p: invert is not all(f(p) for f in filters)  # noqa
+        # the ids come from listing the directory, no need to check they exist
+        rv = [
+            page
+            for page in (Page(id, self) for id in self.get_all_page_ids())
+            if invert is not all(f(page) for f in filters)
+        ]
+        rv.sort(key=key, reverse=reverse)
 
-        rv = filter(keep, map(self._get_page, self.get_all_page_ids()))
-
-        if sort == 'id' or invert:
-            key = lambda p: p.id  # noqa
-        else:
-            if sort not in ('published',):
-                raise ValueError(f"unknown sort: {sort!r}")
-            key = lambda p: p.meta[sort]  # noqa
-
-        rv = sorted(rv, key=key, reverse=reverse)
-
-        return list(rv)
+        return rv
 
     def get_page_ids(self, *, hidden=False, discoverable=True, tags=None, invert=False):
         # TODO: this is inefficient
@@ -71,28 +80,28 @@ class Storage:
             yield page.id
 
     def page_exists(self, id):
-        return os.path.exists(os.path.join(self.path, id) + '.md')
+        return os.path.exists(self._get_page_path(id))
+
+    def _get_page_path(self, id):
+        return os.path.join(self.path, id) + '.md'
+
+    def _get_page_file(self, id):
+        # the stat result is part of the cache key for load_page_*(),
+        # so we only read the file again after it changes
+        path = self._get_page_path(id)
+        stat = os.stat(path)
+        return id, path, (stat.st_mtime_ns, stat.st_size)
 
     def get_page_metadata(self, id):
-        with open(os.path.join(self.path, id) + '.md') as f:
-            lines = list(read_metadata(f))
-        rv = yaml.safe_load(''.join(lines)) or {}
-        if not isinstance(rv, dict):
-            raise ValueError(
-                f"bad metadata (expected dict, got {type(rv).__name__}): {id}"
-            )
-        return rv
+        return load_page_metadata(*self._get_page_file(id))
 
     def get_page_content(self, id):
-        with open(os.path.join(self.path, id) + '.md') as f:
-            for _line in read_metadata(f):
-                pass
-            return f.read()
+        return load_page_content(*self._get_page_file(id))
 
     def _get_page(self, id):
         # used internally, so we can tell external get_page() calls apart
         if not self.page_exists(id):
-            raise FileNotFoundError(os.path.join(self.path, id) + '.md')  # :(
+            raise FileNotFoundError(self._get_page_path(id))  # :(
         return Page(id, self)
 
     def get_page(self, id):
@@ -155,34 +164,26 @@ class Page:
             rv = rv.rstrip()
         return rv
 
-    @property
+    # meta is cached, so validate (and build) these only once
+
+    @cached_property
     def tags(self):
         tags = self.meta.get('tags') or []
-        error = ValueError(f"bad tags for {self.id}: {tags!r}")
-        if not isinstance(tags, list):
-            raise error
-        for tag in tags:
-            if not isinstance(tag, str):
-                raise error
+        if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags):
+            raise ValueError(f"bad tags for {self.id}: {tags!r}")
         return tags
 
-    @property
+    @cached_property
     def tag_feeds(self):
         tag_feeds = self.meta.get('tag-feeds') or []
-        error = ValueError(f"bad tags-feed for {self.id}: {tag_feeds!r}")
-        if not isinstance(tag_feeds, list):
-            raise error
-        for tags in tag_feeds:
-            if not isinstance(tags, list):
-                raise error
-            if not tags:
-                raise error
-            for tag in tags:
-                if not isinstance(tag, str):
-                    raise error
+        if not isinstance(tag_feeds, list) or not all(
+            isinstance(tags, list) and tags and all(isinstance(t, str) for t in tags)
+            for tags in tag_feeds
+        ):
+            raise ValueError(f"bad tags-feed for {self.id}: {tag_feeds!r}")
         return tag_feeds
 
-    @property
+    @cached_property
     def has_feed(self):
         has_feed = self.meta.get('has-feed', False)
         if not isinstance(has_feed, bool):
@@ -190,6 +191,15 @@ class Page:
         return has_feed
 
     @property
+    def feed_max_entries(self):
+        value = self.meta.get('feed-max-entries')
+        if value is None:
+            return None
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f"bad feed-max-entries for {self.id}: {value!r}")
+        return value
+
+    @cached_property
     def series(self):
         return [tag for tag in self.tags if tag.startswith('series-')]
 
@@ -202,6 +212,24 @@ class Page:
         return bool(self.meta.get('discoverable', True))
 
 
+@lru_cache(maxsize=1024)
+def load_page_metadata(id, path, _):
+    with open(path) as f:
+        lines = list(read_metadata(f))
+    rv = yaml.load(''.join(lines), Loader=YAML_LOADER) or {}
+    if not isinstance(rv, dict):
+        raise ValueError(f"bad metadata (expected dict, got {type(rv).__name__}): {id}")
+    return rv
+
+
+@lru_cache(maxsize=1024)
+def load_page_content(id, path, _):
+    with open(path) as f:
+        for _line in read_metadata(f):
+            pass
+        return f.read()
+
+
 def read_metadata(file):
     initial_offset = file.tell()
 
@@ -215,7 +243,8 @@ def read_metadata(file):
         return
 
     for line in file:
-        if line.rstrip() == '---':
+        # startswith() first, to avoid an rstrip() copy for most lines
+        if line.startswith('---') and line.rstrip() == '---':
             break
         yield line
     else:
@@ -0,0 +1,99 @@
+from lxml import etree
+
+from gen.app import create_app
+from gen.app import make_feed
+
+
+ATOM_ENTRY = '{http://www.w3.org/2005/Atom}entry'
+ATOM_ID = '{http://www.w3.org/2005/Atom}id'
+
+
+def make_project(path, index_meta='', pages=('a', 'b', 'c')):
+    content = path.joinpath('content')
+    content.mkdir()
+    content.joinpath('index.md').write_text(
+        "---\n"
+        "title: Site\n"
+        "project-url: https://example.com\n"
+        "has-feed: true\n"
+        "author:\n"
+        "  name: someone\n"
+        f"{index_meta}"
+        "---\n\n"
+        "index\n"
+    )
+    # published in order, so c is the most recent
+    for i, id in enumerate(pages, 1):
+        content.joinpath(f'{id}.md').write_text(
+            f"---\npublished: 2020-01-0{i}T00:00:00Z\n---\n\n{id}\n"
+        )
+    path.joinpath('templates').mkdir()
+    return create_app(str(path))
+
+
+def get_feed_entry_ids(app, url='/_feed/index.xml'):
+    response = app.test_client().get(url)
+    assert response.status_code == 200, response.data
+    root = etree.fromstring(response.data)
+    return [e.find(ATOM_ID).text for e in root.iter(ATOM_ENTRY)]
+
+
+def test_feed_all_entries(tmp_path):
+    app = make_project(tmp_path)
+    assert get_feed_entry_ids(app) == [
+        'https://example.com/c',
+        'https://example.com/b',
+        'https://example.com/a',
+    ]
+
+
+def test_feed_max_entries(tmp_path):
+    app = make_project(tmp_path, "feed-max-entries: 2\n")
+    # the oldest entry is dropped
+    assert get_feed_entry_ids(app) == [
+        'https://example.com/c',
+        'https://example.com/b',
+    ]
+
+
+def test_feed_max_entries_page_overrides_index(tmp_path, monkeypatch):
+    app = make_project(tmp_path, "feed-max-entries: 2\n", pages=('a', 'b', 'c', 'p'))
+    tmp_path.joinpath('content/p.md').write_text(
+        "---\npublished: 2020-01-09T00:00:00Z\nfeed-max-entries: 1\n---\n\np\n"
+    )
+
+    storage = app.extensions['state'].storage
+    # only index has children, so pretend p has the same ones
+    get_children = storage.get_children
+    monkeypatch.setattr(
+        storage,
+        'get_children',
+        lambda id, **kwargs: (
+            c for c in get_children('index', **kwargs) if c.id != 'p'
+        ),
+    )
+
+    with app.test_request_context():
+        index_fg = make_feed(storage, 'index')
+        page_fg = make_feed(storage, 'p')
+
+    assert [e.id() for e in index_fg.entry()] == [
+        'https://example.com/c',
+        'https://example.com/b',
+    ]
+    assert [e.id() for e in page_fg.entry()] == ['https://example.com/c']
+
+
+def test_custom_template_added_later(tmp_path):
+    app = make_project(tmp_path)
+    app.jinja_env.auto_reload = False
+    templates = tmp_path.joinpath('templates')
+    templates.joinpath('base.html').write_text("base {{ page.id }}")
+    client = app.test_client()
+
+    assert client.get('/a').data == b'base a'
+
+    # like in serve, the fallback to base.html must not be cached
+    templates.joinpath('custom').mkdir()
+    templates.joinpath('custom/a.html').write_text("custom {{ page.id }}")
+    assert client.get('/a').data == b'custom a'
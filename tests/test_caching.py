@@ -0,0 +1,75 @@
+import os
+
+import diskcache
+import pytest
+
+from gen.caching import invalidate_cache
+from gen.storage import Storage
+
+
+@pytest.fixture
+def project(tmp_path):
+    tmp_path.joinpath('content').mkdir()
+    tmp_path.joinpath('templates').mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with diskcache.Cache(str(tmp_path.joinpath('cache'))) as cache:
+        yield cache
+
+
+def write_page(project, id, text, mtime):
+    path = project.joinpath('content', f'{id}.md')
+    path.write_text(text)
+    os.utime(path, (mtime, mtime))
+
+
+def invalidate(project, cache):
+    return invalidate_cache(str(project), Storage(str(project / 'content')), cache)
+
+
+def add_node_values(cache, *ids):
+    for id in ids:
+        cache.set(('render_node', id), f'{id} value', tag=f'node:{id}')
+
+
+def test_content_hash(project, cache):
+    write_page(project, 'a', 'one', 1000)
+    write_page(project, 'b', 'two', 1000)
+    # the first run sees gen/ and templates/ as changed, and clears everything
+    invalidate(project, cache)
+    add_node_values(cache, 'a', 'b')
+    old_hashes = cache['hashes']
+
+    # touched, but not changed
+    write_page(project, 'a', 'one', 2000)
+    assert invalidate(project, cache) == set()
+    assert ('render_node', 'a') in cache
+    assert cache['mtimes']['node:a'] == 2000
+    assert cache['hashes'] == old_hashes
+
+    # changed
+    write_page(project, 'a', 'uno', 3000)
+    assert invalidate(project, cache) == {'a'}
+    assert ('render_node', 'a') not in cache
+    assert ('render_node', 'b') in cache
+    assert cache['mtimes']['node:a'] == 3000
+    assert cache['hashes']['node:a'] != old_hashes['node:a']
+    assert cache['hashes']['node:b'] == old_hashes['node:b']
+
+
+def test_transitive_dependencies(project, cache):
+    for id in 'ABCD':
+        write_page(project, id, id, 1000)
+    invalidate(project, cache)
+    add_node_values(cache, *'ABCD')
+    # A includes B, B includes C
+    cache.set('dependencies', {'A': {'B'}, 'B': {'C'}})
+
+    write_page(project, 'C', 'changed', 2000)
+    assert invalidate(project, cache) == {'A', 'B', 'C'}
+    for id in 'ABC':
+        assert ('render_node', id) not in cache, id
+    assert ('render_node', 'D') in cache
@@ -54,10 +54,10 @@ def test_freeze(tmp_path, subtests):
 BROKEN_LINKS_YAML = """\
 one:
   internal-links:
-  - /two#header-error: fragment not found
-  - /two#a-name-error: fragment not found
-  - /two#id-error: fragment not found
-  - /inexistent-node: node not found
+    /inexistent-node: node not found
+    /two#a-name-error: fragment not found
+    /two#header-error: fragment not found
+    /two#id-error: fragment not found
   markdown:
   - 'Unsupported directive: unknown-directive'
   - 'could not render snippet ''unknown-snippet'': TemplateNotFound: snippets/unknown-snippet.html'
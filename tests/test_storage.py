@@ -3,6 +3,7 @@ import io
 import pytest
 
 from gen.storage import read_metadata
+from gen.storage import Storage
 
 
 def test_read_metadata():
@@ -21,3 +22,28 @@ def test_read_metadata():
     with pytest.raises(ValueError):
         list(read_metadata(f))
     assert f.read() == "---\none\n"
+
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        (None, None),
+        ('1', 1),
+        ('10', 10),
+        ('0', ValueError),
+        ('-1', ValueError),
+        ('true', ValueError),
+        ('two', ValueError),
+        ('1.5', ValueError),
+    ],
+)
+def test_page_feed_max_entries(tmp_path, value, expected):
+    meta = f"feed-max-entries: {value}\n" if value is not None else ""
+    tmp_path.joinpath('page.md').write_text(f"---\n{meta}---\n\ncontent\n")
+    page = Storage(str(tmp_path)).get_page('page')
+
+    if expected is ValueError:
+        with pytest.raises(ValueError, match='feed-max-entries'):
+            page.feed_max_entries
+    else:
+        assert page.feed_max_entries == expected